@@ -1,3 +1,19 @@
+from django.apps import apps
 from django.contrib import admin
 
-# Register your models here.
+from gobblegobble.models import SlowHandlerCall
+
+
+class SlowHandlerCallAdmin(admin.ModelAdmin):
+    list_display = ('handler', 'duration', 'allocated_bytes', 'lane', 'started_at')
+    list_filter = ('handler', 'lane')
+    ordering = ('-duration',)
+    readonly_fields = ('handler', 'pattern', 'lane', 'started_at', 'duration', 'allocated_bytes', 'stack', 'profile')
+
+    def has_add_permission(self, request):
+        return False
+
+
+# import_bot_handlers imports this module even in projects without the admin
+if apps.is_installed('django.contrib.admin'):
+    admin.site.register(SlowHandlerCall, SlowHandlerCallAdmin)
@@ -19,8 +19,11 @@ def copy_prefixed_settings(prefix, settings_from, settings_to):
 class GobbleGobbleConfig(AppConfig):
 
     name = 'gobblegobble'
+    default_auto_field = 'django.db.models.AutoField'
 
     def ready(self):
         AppConfig.ready(self)
-        bot = GobbleBot()
+        # import handlers first so the bot is warmed up by the time
+        # it starts listening, or takes over from a previous process
         import_bot_handlers()
+        bot = GobbleBot()
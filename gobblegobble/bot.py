@@ -1,4 +1,4 @@
-from concurrent.futures.thread import ThreadPoolExecutor
+from decimal import Decimal
 import importlib
 import json
 import logging
@@ -6,9 +6,10 @@ import pkgutil
 import random
 import re
 import sys
-from threading import Thread
+from threading import Thread, current_thread
 import time
 import traceback
+import uuid
 
 from django.apps import apps
 from django.conf import settings
@@ -17,12 +18,18 @@ from slackclient import SlackClient
 from websocket._exceptions import WebSocketConnectionClosedException
 
 from gobblegobble.exceptions import GobbleError
+from gobblegobble.handoff import Handoff
+from gobblegobble.lanes import DEFAULT_LANE, INTERACTIVE_LANE, Lane
 from gobblegobble.mock_slackclient import MockSlackClient
-from gobblegobble.registry import RESPONSE_REGISTRY
+from gobblegobble.profiling import HandlerProfiler
+from gobblegobble.registry import LANE_REGISTRY, RESPONSE_REGISTRY
 
 
 LOGGER = logging.getLogger(__name__)
 
+# how long stop_accepting waits for the listener thread, in seconds
+LISTENER_STOP_TIMEOUT = 5
+
 
 def import_submodules(package_name):
     # thank you stack overflow: http://stackoverflow.com/questions/3365740/how-to-import-all-submodules
@@ -46,10 +53,16 @@ def import_bot_handlers():
             import_submodules(app_config.module.__name__)
 
 
-def gobble_listen(matchstr, flags=re.IGNORECASE):
+def gobble_listen(matchstr, flags=re.IGNORECASE, lane=DEFAULT_LANE):
+    """
+    Registers func to handle messages matching matchstr. Handlers run
+    on the worker threads of their lane, see BOT_LANE_WORKER_THREADS.
+    """
     def wrapper(func):
-        RESPONSE_REGISTRY[re.compile(matchstr, flags)] = func
-        LOGGER.info('registered respond_to plugin "%s" to "%s"', func.__name__, matchstr)
+        matcher = re.compile(matchstr, flags)
+        RESPONSE_REGISTRY[matcher] = func
+        LANE_REGISTRY[matcher] = lane
+        LOGGER.info('registered respond_to plugin "%s" to "%s" in lane "%s"', func.__name__, matchstr, lane)
         return func
     return wrapper
 
@@ -84,10 +97,27 @@ class GobbleBot(metaclass=Singleton):
             self._actual_initialize(api_token=api_token)
 
     def _actual_initialize(self, api_token=None):
+        # let a running listener finish up under its old settings first
+        if getattr(self, 'accepting', False):
+            self.stop_accepting()
 
         self.api_token = api_token
         self.bot_loop_sleep_time = .001
         self.num_worker_threads = 5
+        self.lane_worker_threads = {INTERACTIVE_LANE: 2}
+        self.explicit_at_lane = None
+        self.lane_stats_interval = 60
+        self.instance_id = uuid.uuid4().hex
+        self.handoff = None
+        self.owns_handoff = False
+        self.handoff_timeout = 10
+        self.handoff_check_interval = 1
+        self.drain_timeout = 30
+        # lanes outlive a reinitialize so their in-flight work isn't lost
+        if not hasattr(self, 'lanes'):
+            self.lanes = {}
+            self.retired_lanes = []
+        self.accepting = False
         if self.api_token is None:
             if hasattr(settings, 'SLACKBOT_API_TOKEN'):
                 self.api_token = settings.SLACKBOT_API_TOKEN
@@ -100,40 +130,252 @@ class GobbleBot(metaclass=Singleton):
         if hasattr(settings, 'BOT_NUM_WORKER_THREADS'):
             self.num_worker_threads = settings.BOT_NUM_WORKER_THREADS
 
+        if hasattr(settings, 'BOT_LANE_WORKER_THREADS'):
+            self.lane_worker_threads.update(settings.BOT_LANE_WORKER_THREADS)
+
+        # explicit <@bot> mentions get bumped out of the default lane
+        if hasattr(settings, 'BOT_EXPLICIT_AT_LANE'):
+            self.explicit_at_lane = settings.BOT_EXPLICIT_AT_LANE
+
+        if hasattr(settings, 'BOT_LANE_STATS_INTERVAL'):
+            self.lane_stats_interval = settings.BOT_LANE_STATS_INTERVAL
+
+        if hasattr(settings, 'BOT_HANDOFF_FILE'):
+            self.handoff = Handoff(settings.BOT_HANDOFF_FILE)
+
+        if hasattr(settings, 'BOT_HANDOFF_TIMEOUT'):
+            self.handoff_timeout = settings.BOT_HANDOFF_TIMEOUT
+
+        if hasattr(settings, 'BOT_HANDOFF_CHECK_INTERVAL'):
+            self.handoff_check_interval = settings.BOT_HANDOFF_CHECK_INTERVAL
+
+        if hasattr(settings, 'BOT_DRAIN_TIMEOUT'):
+            self.drain_timeout = settings.BOT_DRAIN_TIMEOUT
+
+        # handler profiling is off unless a slow threshold is set
+        if hasattr(self, 'profiler'):
+            self.profiler.stop()
+        self.profiler = HandlerProfiler(
+            slow_threshold=getattr(settings, 'BOT_SLOW_HANDLER_THRESHOLD', None),
+            profile_sample_rate=getattr(settings, 'BOT_PROFILE_SAMPLE_RATE', 0),
+            tracemalloc_sample_rate=getattr(settings, 'BOT_TRACEMALLOC_SAMPLE_RATE', 0),
+            history=getattr(settings, 'BOT_SLOW_HANDLER_HISTORY', 500),
+        )
+
         self.client = _get_slack_client()(self.api_token)
+        self.start()
+
+    def start(self):
+        """
+        Connects to Slack RTM, starts the lane worker pools and the
+        listener thread. Handlers should already be imported by now so
+        the first event doesn't pay for it. With BOT_HANDOFF_FILE set the
+        listener waits for claim_handoff, so a process that is only
+        warming up never answers alongside the one it replaces.
+        """
+        if self.accepting:
+            self.stop_accepting()
         LOGGER.info("Checking slack client")
         if self.client.rtm_connect():
             self.bot_name = self.client.server.login_data['self']['name']
             self.bot_id = self.client.server.login_data['self']['id']
 
-            # start worker pool
-            self.executor = ThreadPoolExecutor(max_workers=self.num_worker_threads)
-
-            thread = Thread(target = self.listen)
-            thread.setDaemon(True)
-            thread.start()
+            self.start_lanes()
+            if self.handoff is None:
+                self.start_listener()
             LOGGER.info("GobbleBot %s is connected to Slack RTM" % self.bot_name)
             self._is_initialized = True
 
         else:
             LOGGER.error("Failed test connection to Slack RTM")
 
-    def listen(self, retry_number=0):
+    def start_lanes(self):
+        """
+        Starts a worker pool per lane, reusing any that are still open and
+        the right size. Lanes that aren't reused are retired: they finish
+        what they already have, and drain and close still wait on them.
+        """
+        lane_sizes = {DEFAULT_LANE: self.num_worker_threads}
+        for lane_name, num_threads in self.lane_worker_threads.items():
+            if lane_name != DEFAULT_LANE:
+                lane_sizes[lane_name] = num_threads
+
+        lanes = {}
+        for lane_name, num_threads in lane_sizes.items():
+            lane = self.lanes.get(lane_name)
+            if lane is None or lane.closed or lane.num_worker_threads != num_threads:
+                lane = Lane(lane_name, num_threads)
+            lanes[lane_name] = lane
+        for lane_name, lane in self.lanes.items():
+            if lanes.get(lane_name) is not lane and not lane.closed:
+                lane.shutdown(cancel_queued=False)
+                self.retired_lanes.append(lane)
+        self.retired_lanes = [lane for lane in self.retired_lanes if lane.in_flight() > 0]
+        self.lanes = lanes
+
+    def all_lanes(self):
+        return list(self.lanes.values()) + self.retired_lanes
+
+    def start_listener(self, previous_owner=None):
+        self.accepting = True
+        self.skip_events_before = None
+        self.last_dispatched_ts = None
+        self.listener_thread = Thread(target=self.run_listener, args=(previous_owner,))
+        self.listener_thread.setDaemon(True)
+        self.listener_thread.start()
+
+    def claim_handoff(self):
+        """
+        Takes over BOT_HANDOFF_FILE from whichever process holds it. Only
+        the process that is meant to be the bot should call this, every
+        other Django process (shell, migrate, ...) leaves it alone. This
+        is what starts the listener, and it pauses until the previous
+        owner lets go.
+        """
+        if self.handoff is None:
+            raise GobbleError("claim_handoff needs BOT_HANDOFF_FILE in django settings")
+        self.stop_accepting()
+        previous_owner = self.handoff.claim(self.instance_id)
+        self.owns_handoff = True
+        self.start_listener(previous_owner)
+
+    def stop_accepting(self):
+        """
+        Stops reading new events from RTM. Work already handed to the
+        lanes keeps running, see drain.
+        """
+        self.accepting = False
+        listener_thread = getattr(self, 'listener_thread', None)
+        if listener_thread is not None and listener_thread is not current_thread():
+            listener_thread.join(LISTENER_STOP_TIMEOUT)
+
+    def drain(self, timeout=None):
+        """
+        Waits until every lane has finished its in-flight work, which
+        includes the replies handlers send. Returns False if the timeout
+        (in seconds) ran out first.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        drained = True
+        for lane in self.all_lanes():
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            if not lane.drain(remaining):
+                LOGGER.warning("Lane %s still has %s events in flight after draining" % (lane.name, lane.in_flight()))
+                drained = False
+        return drained
+
+    def close(self):
+        """
+        Shuts down the lanes, dropping anything still queued, and the
+        RTM connection. start() brings the bot back.
+        """
+        self.stop_accepting()
+        for lane in self.all_lanes():
+            lane.shutdown()
+        self.retired_lanes = []
+        self.profiler.stop()
+        websocket = getattr(self.client.server, 'websocket', None)
+        if websocket is not None:
+            try:
+                websocket.close()
+            except:
+                LOGGER.exception("failed to close RTM websocket")
+        LOGGER.info("GobbleBot %s is closed" % self.instance_id)
+
+    def shutdown(self, timeout=None):
+        """
+        Stops accepting, drains for up to timeout seconds (defaults to
+        BOT_DRAIN_TIMEOUT) and closes. Returns whether the drain finished.
+        """
+        if timeout is None:
+            timeout = self.drain_timeout
+        self.stop_accepting()
+        drained = self.drain(timeout)
+        self.close()
+        return drained
+
+    def run_listener(self, previous_owner=None):
+        if previous_owner:
+            # don't answer anything until the old process lets go
+            LOGGER.info("Waiting for GobbleBot %s to hand off" % previous_owner)
+            release = self.handoff.wait_for_release(self.instance_id, self.handoff_timeout)
+            if release is None:
+                LOGGER.warning("GobbleBot %s never released, starting anyway" % previous_owner)
+            elif release['last_ts'] is not None:
+                self.skip_events_before = Decimal(release['last_ts'])
+        self.listen(connect=False)
+        self.listener_stopped()
+
+    def listener_stopped(self):
+        """
+        Called on the listener thread once it stops reading events. If
+        another process claimed the handoff, tell it the last event we
+        handled and finish up our in-flight work.
+        """
+        if not self.owns_handoff:
+            return
+        self.owns_handoff = False
+        owner = self.handoff.owner()
+        if owner is not None and owner != self.instance_id:
+            last_ts = None
+            if self.last_dispatched_ts is not None:
+                last_ts = str(self.last_dispatched_ts)
+            self.handoff.release(owner, last_ts)
+            LOGGER.info("Handed off to GobbleBot %s, draining" % owner)
+            self.drain(self.drain_timeout)
+            self.close()
+        else:
+            self.handoff.clear(self.instance_id)
+
+    def check_handoff(self):
+        owner = self.handoff.owner()
+        if owner is not None and owner != self.instance_id:
+            LOGGER.info("GobbleBot %s claimed the handoff, no longer accepting events" % owner)
+            self.accepting = False
+
+    def is_stale_event(self, event):
+        # the process we took over from already handled these, compared
+        # by Slack's own ts so local clock skew doesn't matter
+        if self.skip_events_before is None or 'ts' not in event:
+            return False
+        return Decimal(event['ts']) <= self.skip_events_before
+
+    def listen(self, retry_number=0, connect=True):
         if retry_number > 0:
             # backoff retries, max of 5 minute intervals
             timetosleep = min(300, (2 ** retry_number)) + (random.randint(0,1000) / 1000.0)
             LOGGER.error("Attempting reconnection to slack in %s seconds, retry number %s" % (timetosleep, retry_number))
             time.sleep(timetosleep)
+        if not self.accepting:
+            return
         retry_number = retry_number+1
-        if self.client.rtm_connect():
+        # start() has already connected, no need to do it twice
+        if not connect or self.client.rtm_connect():
             # reset it if we connected successfully
             retry_number = 0
             LOGGER.warn("Connected to Slack RTM")
-            while True:
+            last_stats_log = time.monotonic()
+            last_handoff_check = time.monotonic()
+            while self.accepting:
                 try:
                     for event in self.client.rtm_read():
                         LOGGER.debug('New event from RTM: %s' % event)
-                        self.executor.submit(self.handle_event, event)
+                        if not self.is_stale_event(event):
+                            self.dispatch_event(event)
+                            if 'ts' in event:
+                                ts = Decimal(event['ts'])
+                                if self.last_dispatched_ts is None or ts > self.last_dispatched_ts:
+                                    self.last_dispatched_ts = ts
+                    if self.lane_stats_interval and time.monotonic() - last_stats_log >= self.lane_stats_interval:
+                        self.log_lane_stats()
+                        last_stats_log = time.monotonic()
+                    if self.owns_handoff and time.monotonic() - last_handoff_check >= self.handoff_check_interval:
+                        self.check_handoff()
+                        last_handoff_check = time.monotonic()
                     time.sleep(self.bot_loop_sleep_time)
                 except:
                     traceback.print_exc()
@@ -142,7 +384,59 @@ class GobbleBot(metaclass=Singleton):
         else:
             self.listen(retry_number=retry_number)
 
-    def handle_event(self, event):
+    def dispatch_event(self, event):
+        """
+        Hands event off to the worker pool of every lane that has a
+        matching handler. Matching is cheap so it happens right here
+        on the listener thread.
+        """
+        for lane_name in self.lanes_for_event(event):
+            self.lanes[lane_name].submit(self.handle_event, event, lane=lane_name)
+
+    def lanes_for_event(self, event):
+        lane_names = set()
+        try:
+            if event.get('type') == 'message' and GobbleBot.is_message_respondable(event, self.bot_name, self.bot_id):
+                text = Message(event).text
+                for matcher in RESPONSE_REGISTRY.keys():
+                    if matcher.match(text) is not None:
+                        lane_names.add(self.lane_for_handler(matcher, event))
+                if not lane_names:
+                    # the "Sorry, I don't understand" reply
+                    lane_names.add(self.lane_for_handler(None, event))
+        except:
+            LOGGER.exception("failed to pick a lane for RTM event %s, using default lane" % event)
+        if not lane_names:
+            # non-message events still go through handle_event for logging
+            lane_names.add(DEFAULT_LANE)
+        return lane_names
+
+    def lane_for_handler(self, matcher, event):
+        lane_name = self.resolve_lane(LANE_REGISTRY.get(matcher, DEFAULT_LANE))
+        if lane_name == DEFAULT_LANE and self.explicit_at_lane is not None and self.is_explicit_at(event):
+            lane_name = self.resolve_lane(self.explicit_at_lane)
+        return lane_name
+
+    def resolve_lane(self, lane_name):
+        if lane_name not in self.lanes:
+            LOGGER.warning("No workers configured for lane %s, using default lane" % lane_name)
+            return DEFAULT_LANE
+        return lane_name
+
+    def lane_stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+    def log_lane_stats(self):
+        for name, stats in self.lane_stats().items():
+            LOGGER.info("Lane %s: %s workers, %s queued, waits mean %.4fs p50 %.4fs p95 %.4fs max %.4fs" % (
+                name, stats['workers'], stats['queued'], stats['mean_wait'],
+                stats['p50_wait'], stats['p95_wait'], stats['max_wait']))
+
+    def handle_event(self, event, lane=None):
+        """
+        Runs the handlers matching event. When lane is given only the
+        handlers registered to that lane are run.
+        """
         try:
             # throw away anything not a message
             if 'type' in event:
@@ -154,10 +448,12 @@ class GobbleBot(metaclass=Singleton):
                         for matcher in RESPONSE_REGISTRY.keys():
                             matches = matcher.match(message.text)
                             if matches is not None:
+                                if lane is not None and self.lane_for_handler(matcher, event) != lane:
+                                    continue
                                 matched = True
                                 LOGGER.info("Message matched: %s" % matcher)
                                 func = RESPONSE_REGISTRY[matcher]
-                                func(message, *matches.groups())
+                                self.profiler.run(func, matcher, lane, message, *matches.groups())
                         if not matched:
                             message.reply("Sorry, I don't understand \"%s\"" % message.text)
             else:
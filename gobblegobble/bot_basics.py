@@ -1,32 +1,33 @@
 from gobblegobble.bot import gobble_listen
+from gobblegobble.lanes import INTERACTIVE_LANE
 
 
-@gobble_listen('hello')
-@gobble_listen('hi')
+@gobble_listen('hello', lane=INTERACTIVE_LANE)
+@gobble_listen('hi', lane=INTERACTIVE_LANE)
 def hi(message):
     message.respond("Hello <@%s>" % message.sender)
 
 
-@gobble_listen('good morning')
+@gobble_listen('good morning', lane=INTERACTIVE_LANE)
 def good_morning(message):
     message.respond("Good morning <@%s>" % message.sender)
 
 
-@gobble_listen('good afternoon')
+@gobble_listen('good afternoon', lane=INTERACTIVE_LANE)
 def good_afternoon(message):
     message.respond("Good afternoon <@%s>" % message.sender)
 
 
-@gobble_listen('good evening')
+@gobble_listen('good evening', lane=INTERACTIVE_LANE)
 def good_evening(message):
     message.respond("Good evening <@%s>" % message.sender)
 
 
-@gobble_listen('ping')
+@gobble_listen('ping', lane=INTERACTIVE_LANE)
 def ping(message):
     message.respond('pong')
 
 
-@gobble_listen("How's the new body working out?")
+@gobble_listen("How's the new body working out?", lane=INTERACTIVE_LANE)
 def edi_new_body(message):
     message.reply("It is interesting. The crew are approaching this platform to speak with me, even though they can do so anywhere on the ship. It's as if they wish to treat me as part of the crew. I am not, but this changes my perspective. I like it. ")
\ No newline at end of file
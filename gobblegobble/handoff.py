@@ -0,0 +1,72 @@
+import json
+import logging
+import os
+from threading import get_ident
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Handoff():
+    """
+    Coordinates a restart between two bot processes through a file.
+
+    The new process claims the file once it is connected and warmed up.
+    The old process notices the claim, stops reading from RTM and writes
+    a release with the Slack ts of the last event it handled, then
+    drains. The new process waits for that release before handling
+    events, and skips anything at or before that ts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.release_path = '%s.released' % path
+
+    def owner(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def claim(self, owner_id):
+        """
+        Takes over the handoff file, returns the id of the previous owner
+        """
+        previous = self.owner()
+        self._write(self.path, owner_id)
+        return previous
+
+    def clear(self, owner_id):
+        # only clear it if nobody else has claimed it in the meantime
+        if self.owner() == owner_id:
+            self._write(self.path, '')
+
+    def release(self, claimed_by, last_ts):
+        self._write(self.release_path, json.dumps({'claimed_by': claimed_by, 'last_ts': last_ts}))
+
+    def wait_for_release(self, owner_id, timeout, poll_interval=.1):
+        """
+        Waits for the previous owner to release to owner_id. Returns the
+        release, or None if it never released.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with open(self.release_path) as f:
+                    release = json.load(f)
+                if release['claimed_by'] == owner_id:
+                    return release
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def _write(self, path, content):
+        # write then rename so the other process never reads half a file
+        tmp_path = '%s.%s.%s.tmp' % (path, os.getpid(), get_ident())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
@@ -0,0 +1,121 @@
+from collections import deque
+from concurrent.futures.thread import ThreadPoolExecutor
+import logging
+from threading import Condition
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_LANE = 'default'
+INTERACTIVE_LANE = 'interactive'
+
+# how many recent queue waits each lane keeps around for percentiles
+WAIT_SAMPLE_SIZE = 1000
+
+
+class Lane():
+    """
+    A named pool of worker threads. Each lane has its own capacity so
+    slow handlers in one lane can't starve cheap handlers in another.
+    """
+
+    def __init__(self, name, num_worker_threads):
+        self.name = name
+        self.num_worker_threads = num_worker_threads
+        self.executor = ThreadPoolExecutor(max_workers=num_worker_threads, thread_name_prefix='gobble-%s' % name)
+        self._lock = Condition()
+        self.closed = False
+        self.submitted = 0
+        self.started = 0
+        self.finished = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits = deque(maxlen=WAIT_SAMPLE_SIZE)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            # only count it once the executor has taken it, a closed
+            # executor raises RuntimeError
+            future = self.executor.submit(self._run, time.monotonic(), fn, *args, **kwargs)
+            self.submitted += 1
+        future.add_done_callback(self._count_cancelled)
+        return future
+
+    def _count_cancelled(self, future):
+        # cancelled work never reaches _run, so count it as finished here
+        if future.cancelled():
+            with self._lock:
+                self.cancelled += 1
+                self.finished += 1
+                self._lock.notify_all()
+
+    def _run(self, enqueued_at, fn, *args, **kwargs):
+        wait = time.monotonic() - enqueued_at
+        with self._lock:
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.recent_waits.append(wait)
+        LOGGER.debug("Lane %s picked up work after waiting %.4fs" % (self.name, wait))
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.finished += 1
+                self._lock.notify_all()
+
+    def in_flight(self):
+        """
+        Work submitted to this lane that hasn't finished, queued or running
+        """
+        with self._lock:
+            return self.submitted - self.finished
+
+    def drain(self, timeout=None):
+        """
+        Waits for everything submitted to this lane to finish. Returns
+        False if timeout ran out first.
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: self.submitted == self.finished, timeout)
+
+    def shutdown(self, cancel_queued=True):
+        """
+        Stops taking new work. Running work always finishes, queued work
+        is dropped unless cancel_queued is False.
+        """
+        self.closed = True
+        dropped = self.submitted - self.started - self.cancelled
+        self.executor.shutdown(wait=False, cancel_futures=cancel_queued)
+        if cancel_queued and dropped > 0:
+            LOGGER.warning("Lane %s shut down with %s queued events dropped" % (self.name, dropped))
+
+    def stats(self):
+        """
+        Queue wait numbers for this lane, in seconds. Percentiles are
+        over the most recent WAIT_SAMPLE_SIZE pickups.
+        """
+        with self._lock:
+            waits = sorted(self.recent_waits)
+            stats = {
+                'workers': self.num_worker_threads,
+                'submitted': self.submitted,
+                'started': self.started,
+                'queued': self.submitted - self.started - self.cancelled,
+                'cancelled': self.cancelled,
+                'running': self.started - self.finished,
+                'mean_wait': self.total_wait / self.started if self.started else 0.0,
+                'max_wait': self.max_wait,
+            }
+        stats['p50_wait'] = _percentile(waits, 50)
+        stats['p95_wait'] = _percentile(waits, 95)
+        return stats
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
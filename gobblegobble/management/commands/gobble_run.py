@@ -0,0 +1,27 @@
+import signal
+from threading import Event
+
+from django.core.management.base import BaseCommand
+
+from gobblegobble.bot import GobbleBot
+
+
+class Command(BaseCommand):
+    help = "Runs the bot in the foreground, taking over BOT_HANDOFF_FILE if it is set. Stops cleanly on SIGTERM or SIGINT."
+
+    def handle(self, *args, **options):
+        bot = GobbleBot()
+        if bot.handoff is not None:
+            bot.claim_handoff()
+
+        stop_requested = Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop_requested.set())
+
+        # the listener also stops by itself once a newer process takes over
+        while bot.listener_thread.is_alive():
+            if stop_requested.wait(1):
+                self.stdout.write("Draining for up to %s seconds..." % bot.drain_timeout)
+                bot.shutdown()
+                break
+        self.stdout.write("GobbleBot stopped")
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from gobblegobble.models import SlowHandlerCall
+
+
+class Command(BaseCommand):
+    help = "Shows the gobble_listen handlers that recently went over BOT_SLOW_HANDLER_THRESHOLD"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10, help="How many handlers to show")
+        parser.add_argument('--details', action='store_true', help="Also show the stack and profile of each handler's slowest call")
+
+    def handle(self, *args, **options):
+        top_handlers = SlowHandlerCall.top_handlers(limit=options['limit'])
+        if not top_handlers:
+            self.stdout.write("No slow handler calls recorded")
+            return
+        self.stdout.write("%-50s %6s %10s %10s %10s %12s" % ('handler', 'calls', 'total', 'mean', 'max', 'peak mem'))
+        for row in top_handlers:
+            max_allocated = row['max_allocated_bytes']
+            self.stdout.write("%-50s %6d %9.3fs %9.3fs %9.3fs %12s" % (
+                row['handler'], row['calls'], row['total_duration'], row['mean_duration'],
+                row['max_duration'], '-' if max_allocated is None else max_allocated))
+        if options['details']:
+            for row in top_handlers:
+                slowest = SlowHandlerCall.objects.filter(handler=row['handler']).order_by('-duration').first()
+                self.stdout.write("\n%s" % slowest)
+                if slowest.stack:
+                    self.stdout.write(slowest.stack)
+                if slowest.profile:
+                    self.stdout.write(slowest.profile)
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowHandlerCall',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('handler', models.CharField(db_index=True, max_length=255)),
+                ('pattern', models.CharField(blank=True, max_length=255)),
+                ('lane', models.CharField(blank=True, max_length=100)),
+                ('started_at', models.DateTimeField()),
+                ('duration', models.FloatField(help_text='Wall clock seconds')),
+                ('allocated_bytes', models.BigIntegerField(blank=True, help_text='Peak traced memory above the starting point while the handler ran, only for tracemalloc sampled calls', null=True)),
+                ('stack', models.TextField(blank=True, help_text='Where the handler was once it went over the threshold')),
+                ('profile', models.TextField(blank=True, help_text='cProfile output, only for sampled calls')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
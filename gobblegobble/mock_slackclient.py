@@ -69,6 +69,8 @@ class MockSlackClient():
     def __init__(self, token):
         self.token = token
         self.server = MockSlackServer(self.token, False)
+        # tests can append RTM events here for the bot to read
+        self.events = []
 
     def rtm_connect(self):
         # assume we can connect if there's a valid token
@@ -78,7 +80,8 @@ class MockSlackClient():
             return False
 
     def rtm_read(self):
-        return []
+        events, self.events = self.events, []
+        return events
 
     def api_call(self, method, **kwargs):
         result = json.loads(self.server.api_call(method, **kwargs))
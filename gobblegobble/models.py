@@ -1,3 +1,37 @@
 from django.db import models
 
-# Create your models here.
+
+class SlowHandlerCall(models.Model):
+    """
+    A gobble_listen handler call that took longer than
+    BOT_SLOW_HANDLER_THRESHOLD, only the most recent
+    BOT_SLOW_HANDLER_HISTORY are kept.
+    """
+
+    handler = models.CharField(max_length=255, db_index=True)
+    pattern = models.CharField(max_length=255, blank=True)
+    lane = models.CharField(max_length=100, blank=True)
+    started_at = models.DateTimeField()
+    duration = models.FloatField(help_text="Wall clock seconds")
+    allocated_bytes = models.BigIntegerField(null=True, blank=True, help_text="Peak traced memory above the starting point while the handler ran, only for tracemalloc sampled calls")
+    stack = models.TextField(blank=True, help_text="Where the handler was once it went over the threshold")
+    profile = models.TextField(blank=True, help_text="cProfile output, only for sampled calls")
+
+    class Meta:
+        ordering = ['-started_at']
+
+    def __str__(self):
+        return "%s took %.3fs" % (self.handler, self.duration)
+
+    @classmethod
+    def top_handlers(cls, limit=10):
+        """
+        Handlers with the most total time spent in slow calls
+        """
+        return cls.objects.values('handler').annotate(
+            calls=models.Count('id'),
+            total_duration=models.Sum('duration'),
+            mean_duration=models.Avg('duration'),
+            max_duration=models.Max('duration'),
+            max_allocated_bytes=models.Max('allocated_bytes'),
+        ).order_by('-total_duration')[:limit]
@@ -0,0 +1,206 @@
+import cProfile
+from datetime import datetime, timezone
+import io
+import logging
+import pstats
+import random
+import sys
+from threading import Event, Lock, Thread, get_ident
+import time
+import traceback
+import tracemalloc
+
+from django.db import close_old_connections
+
+
+LOGGER = logging.getLogger(__name__)
+
+# how many functions of a sampled cProfile run get saved
+PROFILE_STATS_LINES = 30
+
+
+class HandlerProfiler():
+    """
+    Opt-in timing of gobble_listen handlers. Every call is timed, which
+    is cheap. Calls over slow_threshold seconds are saved as
+    SlowHandlerCall rows, along with the handler's stack at the moment
+    it went over. A random profile_sample_rate fraction of calls also
+    run under cProfile, and a tracemalloc_sample_rate fraction have
+    their peak memory measured, so the expensive bits stay bounded.
+    """
+
+    def __init__(self, slow_threshold=None, profile_sample_rate=0, tracemalloc_sample_rate=0, history=500):
+        self.slow_threshold = slow_threshold
+        self.profile_sample_rate = profile_sample_rate
+        self.tracemalloc_sample_rate = tracemalloc_sample_rate
+        self.history = history
+        # cProfile can only have one profiler active at a time, and the
+        # tracemalloc peak is process wide so only one call is measured
+        self._profile_lock = Lock()
+        self._tracemalloc_lock = Lock()
+        self._started_tracemalloc = False
+        self._calls_lock = Lock()
+        self._calls = {}
+        self._watchdog = None
+        self._watchdog_stop = None
+        # trimming to history is amortized over this many slow calls
+        self.trim_every = max(1, history // 10)
+        self._records_lock = Lock()
+        self._records_since_trim = 0
+
+    @property
+    def enabled(self):
+        return self.slow_threshold is not None
+
+    def run(self, func, matcher, lane, *args):
+        if not self.enabled:
+            return func(*args)
+        self._start_watchdog()
+
+        profile = None
+        if self.profile_sample_rate and random.random() < self.profile_sample_rate:
+            if self._profile_lock.acquire(blocking=False):
+                profile = cProfile.Profile()
+        traced = False
+        if self.tracemalloc_sample_rate and random.random() < self.tracemalloc_sample_rate:
+            traced = self._tracemalloc_lock.acquire(blocking=False)
+        if traced:
+            allocated_before = self._start_tracemalloc()
+
+        call = {'started': time.monotonic(), 'stack': None}
+        with self._calls_lock:
+            self._calls[get_ident()] = call
+        started_at = datetime.now(timezone.utc)
+        try:
+            if profile is not None:
+                return profile.runcall(func, *args)
+            return func(*args)
+        finally:
+            duration = time.monotonic() - call['started']
+            with self._calls_lock:
+                del self._calls[get_ident()]
+            allocated_bytes = None
+            if traced:
+                allocated_bytes = self._stop_tracemalloc(allocated_before)
+            profile_text = ''
+            if profile is not None:
+                profile_text = _format_profile(profile)
+                self._profile_lock.release()
+            if duration >= self.slow_threshold:
+                self.record(func, matcher, lane, started_at, duration, allocated_bytes, call['stack'] or '', profile_text)
+
+    def record(self, func, matcher, lane, started_at, duration, allocated_bytes, stack, profile):
+        # models can't be imported until django has loaded the apps
+        from gobblegobble.models import SlowHandlerCall
+
+        handler = '%s.%s' % (func.__module__, func.__qualname__)
+        LOGGER.warning("Slow handler %s took %.3fs" % (handler, duration))
+        # lane worker threads live forever, so django never cleans up
+        # their connections on its own
+        close_old_connections()
+        try:
+            SlowHandlerCall.objects.create(
+                handler=handler,
+                pattern=getattr(matcher, 'pattern', '')[:255],
+                lane=lane or '',
+                started_at=started_at,
+                duration=duration,
+                allocated_bytes=allocated_bytes,
+                stack=stack,
+                profile=profile,
+            )
+            if self._trim_due():
+                self.trim()
+        except:
+            LOGGER.exception("failed to record slow handler call for %s" % handler)
+        finally:
+            close_old_connections()
+
+    def _trim_due(self):
+        with self._records_lock:
+            self._records_since_trim += 1
+            if self._records_since_trim < self.trim_every:
+                return False
+            self._records_since_trim = 0
+            return True
+
+    def trim(self):
+        """
+        Keeps a rolling window of the newest history slow calls
+        """
+        from gobblegobble.models import SlowHandlerCall
+
+        stale = SlowHandlerCall.objects.order_by('-id').values_list('id', flat=True)[self.history:self.history + 1]
+        if stale:
+            SlowHandlerCall.objects.filter(id__lte=stale[0]).delete()
+
+    def stop(self):
+        """
+        Stops the watchdog thread, the next profiled call starts a new one
+        """
+        with self._calls_lock:
+            if self._watchdog is not None:
+                self._watchdog_stop.set()
+                self._watchdog = None
+
+    def _start_watchdog(self):
+        if self._watchdog is None:
+            with self._calls_lock:
+                if self._watchdog is None:
+                    self._watchdog_stop = Event()
+                    self._watchdog = Thread(target=self._watch, args=(self._watchdog_stop,), name='gobble-profiler')
+                    self._watchdog.daemon = True
+                    self._watchdog.start()
+
+    def _watch(self, stop):
+        """
+        Grabs the stack of any handler still running past the threshold
+        so slow reports show where it was stuck, not just that it was.
+        """
+        interval = max(.01, self.slow_threshold / 2.0)
+        while not stop.wait(interval):
+            now = time.monotonic()
+            with self._calls_lock:
+                overdue = [(ident, call) for ident, call in self._calls.items()
+                           if call['stack'] is None and now - call['started'] >= self.slow_threshold]
+            if not overdue:
+                continue
+            frames = sys._current_frames()
+            for ident, call in overdue:
+                if ident in frames:
+                    stack = ''.join(traceback.format_stack(frames[ident]))
+                    with self._calls_lock:
+                        # the thread may have moved on to another handler
+                        if self._calls.get(ident) is call:
+                            call['stack'] = stack
+
+    def _start_tracemalloc(self):
+        # called holding _tracemalloc_lock
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def _stop_tracemalloc(self, allocated_before):
+        """
+        Returns how far traced memory peaked above allocated_before while
+        the handler ran, so memory it allocated and freed still counts.
+        Other threads allocating at the same time are included too.
+        """
+        try:
+            peak = tracemalloc.get_traced_memory()[1]
+            # leave it alone if someone else turned tracing on
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+            return max(0, peak - allocated_before)
+        finally:
+            self._tracemalloc_lock.release()
+
+
+def _format_profile(profile):
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+    return output.getvalue()
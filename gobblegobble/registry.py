@@ -1,2 +1,5 @@
 
 RESPONSE_REGISTRY = {}
+
+# compiled matcher -> lane name, anything missing runs in the default lane
+LANE_REGISTRY = {}
@@ -10,6 +10,7 @@ SLACKBOT_API_TOKEN='testtoken'
 BOT_LOOP_SLEEP_TIME = .001
 SECRET_KEY = 'fake-key'
 INSTALLED_APPS = [
+    "gobblegobble",
     "tests",
 ]
 
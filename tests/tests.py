@@ -1,13 +1,24 @@
+from decimal import Decimal
+from io import StringIO
 import json
+import os
+import re
+import tempfile
+from threading import Event
 import time
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.test import TestCase
 from django.test.utils import override_settings
 
-from gobblegobble.bot import GobbleBot, Message
+from gobblegobble.bot import GobbleBot, Message, gobble_listen
 from gobblegobble.exceptions import GobbleError
+from gobblegobble.handoff import Handoff
+from gobblegobble.lanes import DEFAULT_LANE, INTERACTIVE_LANE, Lane
+from gobblegobble.models import SlowHandlerCall
+from gobblegobble.profiling import HandlerProfiler
 from gobblegobble.mock_slackclient import MockSlackRequester
 
 
@@ -81,6 +92,411 @@ class TestGobbleBot(TestCase):
         self.assertRaises(GobbleError, bot.send_message, message)
 
 
+@gobble_listen('lanetest slow')
+def lanetest_slow(message):
+    message.respond('slow')
+
+
+@gobble_listen('lanetest fast', lane=INTERACTIVE_LANE)
+def lanetest_fast(message):
+    message.respond('fast')
+
+
+@gobble_listen('lanetest nowhere', lane='nosuchlane')
+def lanetest_nowhere(message):
+    message.respond('nowhere')
+
+
+@override_settings(MOCK_SLACK=True)
+class TestLanes(TestCase):
+
+    def make_event(self, text):
+        return {'type': 'message', 'team': 'TFAKE123', 'user': 'UFAKE123', 'text': text, 'channel': 'CFAKE123'}
+
+    def test_lanes_for_event(self):
+        bot = GobbleBot(api_token='faketoken')
+        self.assertEqual(bot.lanes_for_event(self.make_event('%s lanetest slow' % bot.bot_name)), {DEFAULT_LANE})
+        self.assertEqual(bot.lanes_for_event(self.make_event('%s lanetest fast' % bot.bot_name)), {INTERACTIVE_LANE})
+        # unmatched messages still need a lane for the "don't understand" reply
+        self.assertEqual(bot.lanes_for_event(self.make_event('%s lanetest huh' % bot.bot_name)), {DEFAULT_LANE})
+        self.assertEqual(bot.lanes_for_event({'type': 'hello'}), {DEFAULT_LANE})
+
+    def test_unknown_lane_falls_back_to_default(self):
+        bot = GobbleBot(api_token='faketoken')
+        self.assertEqual(bot.lanes_for_event(self.make_event('%s lanetest nowhere' % bot.bot_name)), {DEFAULT_LANE})
+
+    def test_explicit_at_lane(self):
+        bot = GobbleBot(api_token='faketoken')
+        at_event = self.make_event('<@%s> lanetest slow' % bot.bot_id)
+        self.assertEqual(bot.lanes_for_event(at_event), {DEFAULT_LANE})
+        with self.settings(BOT_EXPLICIT_AT_LANE=INTERACTIVE_LANE):
+            bot._actual_initialize(api_token='faketoken')
+            self.assertEqual(bot.lanes_for_event(at_event), {INTERACTIVE_LANE})
+            self.assertEqual(bot.lanes_for_event(self.make_event('%s lanetest slow' % bot.bot_name)), {DEFAULT_LANE})
+        bot._actual_initialize(api_token='faketoken')
+
+    def test_lane_worker_threads_setting(self):
+        bot = GobbleBot(api_token='faketoken')
+        with self.settings(BOT_LANE_WORKER_THREADS={'reports': 1}, BOT_NUM_WORKER_THREADS=3):
+            bot._actual_initialize(api_token='faketoken')
+            self.assertEqual(bot.lanes['reports'].num_worker_threads, 1)
+            self.assertEqual(bot.lanes[INTERACTIVE_LANE].num_worker_threads, 2)
+            self.assertEqual(bot.lanes[DEFAULT_LANE].num_worker_threads, 3)
+        bot._actual_initialize(api_token='faketoken')
+
+    def test_handle_event_only_runs_handlers_in_lane(self):
+        bot = GobbleBot(api_token='faketoken')
+        responses = []
+        original_send = bot.send_message
+        bot.send_message = lambda message: responses.append(message.full_text)
+        try:
+            event = self.make_event('%s lanetest fast' % bot.bot_name)
+            bot.handle_event(event, lane=INTERACTIVE_LANE)
+            self.assertEqual(responses, ['fast'])
+        finally:
+            bot.send_message = original_send
+
+    def test_shutdown_counts_cancelled_work(self):
+        lane = Lane('testlane', 1)
+        started, release = Event(), Event()
+        running = lane.submit(lambda: started.set() or release.wait(5))
+        self.assertTrue(started.wait(1))
+        lane.submit(time.sleep, 0)
+        lane.submit(time.sleep, 0)
+        lane.shutdown()
+        release.set()
+        running.result(1)
+        self.assertTrue(lane.drain(timeout=1))
+        self.assertEqual(lane.in_flight(), 0)
+        self.assertRaises(RuntimeError, lane.submit, time.sleep, 0)
+        self.assertEqual(lane.in_flight(), 0)
+        stats = lane.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['cancelled'], 2)
+
+    def test_lane_stats(self):
+        lane = Lane('testlane', 1)
+        self.assertEqual(lane.submit(lambda x: x * 2, 21).result(), 42)
+        lane.submit(time.sleep, .05)
+        lane.submit(lambda: None).result()
+        stats = lane.stats()
+        self.assertEqual(stats['workers'], 1)
+        self.assertEqual(stats['submitted'], 3)
+        self.assertEqual(stats['started'], 3)
+        self.assertEqual(stats['queued'], 0)
+        self.assertGreaterEqual(stats['max_wait'], .04)
+        self.assertGreaterEqual(stats['p95_wait'], stats['p50_wait'])
+
+
+LIFECYCLE_HANDLER_CALLED = Event()
+LIFECYCLE_HANDLER_RELEASE = Event()
+
+
+@gobble_listen('lifecycletest block')
+def lifecycletest_block(message):
+    LIFECYCLE_HANDLER_CALLED.set()
+    LIFECYCLE_HANDLER_RELEASE.wait(5)
+    message.respond('unblocked')
+
+
+@override_settings(MOCK_SLACK=True)
+class TestLifecycle(TestCase):
+
+    def setUp(self):
+        LIFECYCLE_HANDLER_CALLED.clear()
+        LIFECYCLE_HANDLER_RELEASE.clear()
+        self.bot = GobbleBot(api_token='faketoken')
+        self.bot._actual_initialize(api_token='faketoken')
+
+    def tearDown(self):
+        LIFECYCLE_HANDLER_RELEASE.set()
+        # leave a running bot behind for the other tests
+        self.bot._actual_initialize(api_token='faketoken')
+
+    def make_event(self, text):
+        return {'type': 'message', 'team': 'TFAKE123', 'user': 'UFAKE123', 'text': text, 'channel': 'CFAKE123', 'ts': '%s' % time.time()}
+
+    def test_stop_accepting(self):
+        self.bot.stop_accepting()
+        self.assertFalse(self.bot.listener_thread.is_alive())
+        self.bot.client.events.append(self.make_event('%s lifecycletest block' % self.bot.bot_name))
+        time.sleep(.05)
+        self.assertFalse(LIFECYCLE_HANDLER_CALLED.is_set())
+
+    def test_drain_with_deadline(self):
+        self.bot.client.events.append(self.make_event('%s lifecycletest block' % self.bot.bot_name))
+        self.assertTrue(LIFECYCLE_HANDLER_CALLED.wait(1))
+        self.bot.stop_accepting()
+        self.assertFalse(self.bot.drain(timeout=.01))
+        LIFECYCLE_HANDLER_RELEASE.set()
+        self.assertTrue(self.bot.drain(timeout=1))
+        self.assertEqual(self.bot.lanes['default'].in_flight(), 0)
+
+    def test_close_and_start(self):
+        self.bot.close()
+        self.assertFalse(self.bot.accepting)
+        self.assertRaises(RuntimeError, self.bot.lanes['default'].submit, time.sleep, 0)
+        self.bot.start()
+        self.assertTrue(self.bot.accepting)
+        self.assertTrue(self.bot.listener_thread.is_alive())
+        self.bot.client.events.append(self.make_event('%s lifecycletest block' % self.bot.bot_name))
+        self.assertTrue(LIFECYCLE_HANDLER_CALLED.wait(1))
+
+    def test_restart_reuses_lanes(self):
+        lanes = dict(self.bot.lanes)
+        self.bot.stop_accepting()
+        self.bot.start()
+        self.assertEqual(self.bot.lanes, lanes)
+
+    def test_drain_waits_for_retired_lanes(self):
+        self.bot.client.events.append(self.make_event('%s lifecycletest block' % self.bot.bot_name))
+        self.assertTrue(LIFECYCLE_HANDLER_CALLED.wait(1))
+        old_default = self.bot.lanes['default']
+        with self.settings(BOT_NUM_WORKER_THREADS=2):
+            self.bot._actual_initialize(api_token='faketoken')
+        self.assertIsNot(self.bot.lanes['default'], old_default)
+        self.assertIn(old_default, self.bot.retired_lanes)
+        self.bot.stop_accepting()
+        self.assertFalse(self.bot.drain(timeout=.01))
+        LIFECYCLE_HANDLER_RELEASE.set()
+        self.assertTrue(self.bot.drain(timeout=1))
+        self.assertEqual(old_default.in_flight(), 0)
+
+    def test_shutdown(self):
+        self.bot.client.events.append(self.make_event('%s lifecycletest block' % self.bot.bot_name))
+        self.assertTrue(LIFECYCLE_HANDLER_CALLED.wait(1))
+        LIFECYCLE_HANDLER_RELEASE.set()
+        self.assertTrue(self.bot.shutdown(timeout=1))
+        self.assertFalse(self.bot.listener_thread.is_alive())
+
+    def test_hands_off_to_new_owner(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'handoff')
+            with self.settings(BOT_HANDOFF_FILE=path, BOT_HANDOFF_CHECK_INTERVAL=.01):
+                self.bot._actual_initialize(api_token='faketoken')
+                self.bot.claim_handoff()
+                self.assertEqual(Handoff(path).owner(), self.bot.instance_id)
+                # a new process has connected and warmed up
+                self.assertEqual(Handoff(path).claim('newprocess'), self.bot.instance_id)
+                release = Handoff(path).wait_for_release('newprocess', 1)
+                self.assertIsNotNone(release)
+                self.bot.listener_thread.join(1)
+                self.assertFalse(self.bot.accepting)
+                # nothing was dispatched, so nothing for the new process to skip
+                self.assertIsNone(release['last_ts'])
+
+    def test_releases_last_dispatched_ts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'handoff')
+            with self.settings(BOT_HANDOFF_FILE=path, BOT_HANDOFF_CHECK_INTERVAL=.01):
+                self.bot._actual_initialize(api_token='faketoken')
+                self.bot.claim_handoff()
+                self.bot.client.events.append({'type': 'message', 'user': 'UFAKE123', 'text': 'not for the bot', 'channel': 'CFAKE123', 'ts': '1459618786.000032'})
+                self.bot.client.events.append({'type': 'message', 'user': 'UFAKE123', 'text': 'not for the bot', 'channel': 'CFAKE123', 'ts': '1459618786.000031'})
+                time.sleep(.05)
+                Handoff(path).claim('newprocess')
+                release = Handoff(path).wait_for_release('newprocess', 1)
+                self.assertEqual(release['last_ts'], '1459618786.000032')
+
+    def test_clean_shutdown_clears_handoff(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'handoff')
+            with self.settings(BOT_HANDOFF_FILE=path):
+                self.bot._actual_initialize(api_token='faketoken')
+                self.bot.claim_handoff()
+                self.bot.shutdown(timeout=1)
+                self.assertIsNone(Handoff(path).owner())
+
+    def test_only_claims_handoff_when_asked(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'handoff')
+            Handoff(path).claim('runningbot')
+            with self.settings(BOT_HANDOFF_FILE=path, BOT_HANDOFF_CHECK_INTERVAL=.01):
+                # e.g. manage.py shell, which loads the app but isn't the bot
+                self.bot._actual_initialize(api_token='faketoken')
+                time.sleep(.05)
+                self.assertEqual(Handoff(path).owner(), 'runningbot')
+                self.assertFalse(self.bot.accepting)
+                self.bot.shutdown(timeout=1)
+                self.assertEqual(Handoff(path).owner(), 'runningbot')
+
+    def test_nothing_is_answered_before_release(self):
+        sent = []
+        self.bot.send_message = lambda message: sent.append(message.full_text)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'handoff')
+                Handoff(path).claim('oldprocess')
+                with self.settings(BOT_HANDOFF_FILE=path, BOT_HANDOFF_TIMEOUT=5):
+                    # the app is loaded but not yet claimed, like during system checks
+                    self.bot._actual_initialize(api_token='faketoken')
+                    handled = self.make_event('%s lanetest fast' % self.bot.bot_name)
+                    self.bot.client.events.append(handled)
+                    time.sleep(.05)
+                    self.assertEqual(sent, [])
+                    self.bot.claim_handoff()
+                    time.sleep(.05)
+                    self.assertEqual(sent, [])
+                    new = self.make_event('%s lanetest fast' % self.bot.bot_name)
+                    self.bot.client.events.append(new)
+                    # the old process answered the first event before letting go
+                    Handoff(path).release(self.bot.instance_id, handled['ts'])
+                    for i in range(100):
+                        if sent:
+                            break
+                        time.sleep(.01)
+                    self.bot.shutdown(timeout=1)
+                    self.assertEqual(sent, ['fast'])
+                    self.assertEqual(self.bot.last_dispatched_ts, Decimal(new['ts']))
+        finally:
+            del self.bot.send_message
+
+    def test_claim_handoff_needs_setting(self):
+        self.assertRaises(GobbleError, self.bot.claim_handoff)
+
+    def test_waits_for_previous_owner(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'handoff')
+            Handoff(path).claim('oldprocess')
+            with self.settings(BOT_HANDOFF_FILE=path, BOT_HANDOFF_TIMEOUT=.05):
+                self.bot._actual_initialize(api_token='faketoken')
+                self.bot.claim_handoff()
+                self.bot.client.events.append(self.make_event('%s lifecycletest block' % self.bot.bot_name))
+                # the old process never released, so it starts on its own
+                self.assertTrue(LIFECYCLE_HANDLER_CALLED.wait(1))
+                self.assertIsNone(self.bot.skip_events_before)
+                LIFECYCLE_HANDLER_RELEASE.set()
+                self.bot.shutdown(timeout=1)
+
+    def test_is_stale_event(self):
+        self.bot.skip_events_before = Decimal('1459618786.000032')
+        self.assertTrue(self.bot.is_stale_event({'type': 'message', 'ts': '1459618786.000032'}))
+        self.assertTrue(self.bot.is_stale_event({'type': 'message', 'ts': '1459618786.000031'}))
+        self.assertFalse(self.bot.is_stale_event({'type': 'message', 'ts': '1459618786.000033'}))
+        self.assertFalse(self.bot.is_stale_event({'type': 'hello'}))
+
+
+def profiletest_scratch_handler(message):
+    scratch = bytearray(1000000)
+    del scratch
+
+
+def profiletest_handler(message, delay=0):
+    time.sleep(delay)
+    return [message] * 1000
+
+
+@override_settings(MOCK_SLACK=True)
+class TestHandlerProfiler(TestCase):
+
+    matcher = re.compile('profiletest')
+
+    def test_disabled_by_default(self):
+        profiler = HandlerProfiler()
+        self.assertFalse(profiler.enabled)
+        self.assertEqual(len(profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')), 1000)
+        self.assertEqual(SlowHandlerCall.objects.count(), 0)
+
+    def test_fast_calls_are_not_recorded(self):
+        profiler = HandlerProfiler(slow_threshold=10)
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        self.assertEqual(SlowHandlerCall.objects.count(), 0)
+
+    def test_slow_call_is_recorded_with_stack(self):
+        profiler = HandlerProfiler(slow_threshold=.02)
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi', .1)
+        call = SlowHandlerCall.objects.get()
+        self.assertEqual(call.handler, 'tests.tests.profiletest_handler')
+        self.assertEqual(call.pattern, 'profiletest')
+        self.assertEqual(call.lane, DEFAULT_LANE)
+        self.assertGreaterEqual(call.duration, .1)
+        self.assertIn('profiletest_handler', call.stack)
+        self.assertEqual(call.profile, '')
+        self.assertIsNone(call.allocated_bytes)
+
+    def test_stop_watchdog(self):
+        profiler = HandlerProfiler(slow_threshold=10)
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        watchdog = profiler._watchdog
+        self.assertTrue(watchdog.is_alive())
+        profiler.stop()
+        watchdog.join(1)
+        self.assertFalse(watchdog.is_alive())
+        # comes back for the next call
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        self.assertTrue(profiler._watchdog.is_alive())
+        profiler.stop()
+
+    def test_bot_stops_old_profiler(self):
+        bot = GobbleBot(api_token='faketoken')
+        with self.settings(BOT_SLOW_HANDLER_THRESHOLD=10):
+            bot._actual_initialize(api_token='faketoken')
+            bot.profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+            watchdog = bot.profiler._watchdog
+            bot._actual_initialize(api_token='faketoken')
+            watchdog.join(1)
+            self.assertFalse(watchdog.is_alive())
+            bot.profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+            watchdog = bot.profiler._watchdog
+            bot.close()
+            watchdog.join(1)
+            self.assertFalse(watchdog.is_alive())
+        bot._actual_initialize(api_token='faketoken')
+
+    def test_sampled_profile_and_allocations(self):
+        profiler = HandlerProfiler(slow_threshold=0, profile_sample_rate=1, tracemalloc_sample_rate=1)
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        call = SlowHandlerCall.objects.get()
+        self.assertIn('profiletest_handler', call.profile)
+        self.assertGreater(call.allocated_bytes, 0)
+
+    def test_allocations_freed_by_the_handler_still_count(self):
+        profiler = HandlerProfiler(slow_threshold=0, tracemalloc_sample_rate=1)
+        profiler.run(profiletest_scratch_handler, self.matcher, DEFAULT_LANE, 'hi')
+        self.assertGreaterEqual(SlowHandlerCall.objects.get().allocated_bytes, 1000000)
+        self.assertFalse(profiler._tracemalloc_lock.locked())
+
+    def test_history_is_rolling(self):
+        profiler = HandlerProfiler(slow_threshold=0, history=3)
+        for i in range(5):
+            profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        self.assertEqual(SlowHandlerCall.objects.count(), 3)
+
+    def test_history_is_trimmed_periodically(self):
+        profiler = HandlerProfiler(slow_threshold=0, history=20)
+        self.assertEqual(profiler.trim_every, 2)
+        for i in range(21):
+            profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        # the 21st call isn't a trim call
+        self.assertEqual(SlowHandlerCall.objects.count(), 21)
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        self.assertEqual(SlowHandlerCall.objects.count(), 20)
+
+    def test_handle_event_uses_profiler(self):
+        with self.settings(BOT_SLOW_HANDLER_THRESHOLD=0):
+            bot = GobbleBot(api_token='faketoken')
+            bot._actual_initialize(api_token='faketoken')
+            bot.send_message = lambda message: None
+            bot.handle_event({'type': 'message', 'user': 'UFAKE123', 'text': '%s lanetest fast' % bot.bot_name, 'channel': 'CFAKE123'}, lane=INTERACTIVE_LANE)
+            del bot.send_message
+        bot._actual_initialize(api_token='faketoken')
+        call = SlowHandlerCall.objects.get()
+        self.assertEqual(call.handler, 'tests.tests.lanetest_fast')
+        self.assertEqual(call.lane, INTERACTIVE_LANE)
+
+    def test_gobble_slow_handlers_command(self):
+        out = StringIO()
+        call_command('gobble_slow_handlers', stdout=out)
+        self.assertIn('No slow handler calls recorded', out.getvalue())
+        profiler = HandlerProfiler(slow_threshold=0, profile_sample_rate=1)
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        profiler.run(profiletest_handler, self.matcher, DEFAULT_LANE, 'hi')
+        out = StringIO()
+        call_command('gobble_slow_handlers', '--details', stdout=out)
+        self.assertIn('tests.tests.profiletest_handler', out.getvalue())
+        self.assertIn('function calls', out.getvalue())
+
+
 @override_settings(MOCK_SLACK=True)
 class TestSlackMessage(TestCase):
 